@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # This script can produce csv files locally or send
 # results to a remote influx 1.0.2 database.
@@ -51,12 +51,12 @@ import time
 
 
 def printUseageAndQuit():
-    print ("This python script can produce local csv files or "
-           "send benchmark stats to a remote influx database.")
-    print "Useage:"
-    print "./parse_bench_hist.py --local [outputdir [inputdir]]"
-    print "./parse_bench_hist.py --local-html [outputdir [inputdir]]"
-    print "./parse_bench_hist.py --remote ip_address [inputdir [inputfile]]"
+    print("This python script can produce local csv files or "
+          "send benchmark stats to a remote influx database.")
+    print("Useage:")
+    print("./parse_bench_hist.py --local [outputdir [inputdir]]")
+    print("./parse_bench_hist.py --local-html [outputdir [inputdir]]")
+    print("./parse_bench_hist.py --remote ip_address [inputdir [inputfile]]")
     exit()
 
 
@@ -130,7 +130,7 @@ def find_ndx(inlist, item):
 def getReadableSha(verboseSha):
     process = subprocess.Popen(["git", "describe", verboseSha],
                                stdout=subprocess.PIPE)
-    output = process.communicate()[0]
+    output = process.communicate()[0].decode()
     output = output.replace('\n', '')
     if not output:
         return verboseSha
@@ -141,19 +141,19 @@ def transform(inputdir, destination, filelist, handler):
     for inputfile in filelist:
         file_name = os.path.splitext(os.path.basename(inputfile))[0].split("_")
         if len(file_name) != 2:
-            print "Expecting input files of format 'timestamp_sha.csv'"
+            print("Expecting input files of format 'timestamp_sha.csv'")
             exit()
         timestamp = file_name[0]
         sha = file_name[1]
         tag = getReadableSha(sha)
-        print "column sha:" + sha
+        print("column sha:" + sha)
         with open(inputfile) as fin:
             csvr = csv.reader(fin)
             header = {}
             try:
-                header = csvr.next()
+                header = next(csvr)
             except StopIteration:
-                print "skipping empty file: " + str(inputfile)
+                print("skipping empty file: " + str(inputfile))
                 continue
             min_ndx = find_ndx(header, "min")
             max_ndx = find_ndx(header, "max")
@@ -177,12 +177,12 @@ def transform_stats(inputdir, destination, filelist):
     for inputfile in filelist:
         file_name = os.path.splitext(os.path.basename(inputfile))[0].split("_")
         if len(file_name) != 2:
-            print "Expecting input files of format 'timestamp_sha.stats'"
+            print("Expecting input files of format 'timestamp_sha.stats'")
             exit()
         timestamp = file_name[0]
         sha = file_name[1]
         tag = getReadableSha(sha)
-        print "column sha:" + sha
+        print("column sha:" + sha)
         with open(inputfile) as fin:
             lines = fin.readlines()
             for line in lines:
@@ -220,7 +220,7 @@ def handle_stats(info):
             keys.append(v[0])
             info[v[0]] = v[1]
         else:
-            print "unhandled column" + str(v)
+            print("unhandled column" + str(v))
     header = ''
     if not os.path.exists(outfilename):
         header = ','.join(map(str, keys)) + "\n"
@@ -267,7 +267,7 @@ def handle_local_horizontal(info):
     with open(outfilename, 'w+') as fout:
         fout.seek(0)
     keys = ['sha', 'min', 'max', 'med', 'avg']
-    for idx in xrange(len(keys)):
+    for idx in range(len(keys)):
         newrow = lines[idx] + info[keys[idx]] + endline
         fout.write(newrow)
     fout.truncate()
@@ -295,16 +295,16 @@ def transform_local(html=False):
         outputdir = sys.argv[2]
     outputdir = os.path.expanduser(outputdir)
     mkdirs(outputdir)
-    print "results will be written to " + outputdir
+    print("results will be written to " + outputdir)
 
     inputdir = "~/.realm/core/benchmarks/"
     if len(sys.argv) >= 4:
         inputdir = sys.argv[3]
     if len(sys.argv) > 4:
-        print "Unexpected extra arguments."
+        print("Unexpected extra arguments.")
         printUseageAndExit()
     inputdir = os.path.expanduser(inputdir) + str(version) + "/" + str(machid)
-    print "looking for csv files in " + inputdir
+    print("looking for csv files in " + inputdir)
     files = getFilesByName(inputdir)
 
     transform(inputdir, outputdir, files, handle_local_vertical)
@@ -319,7 +319,7 @@ def transform_remote():
     machid = getMachId()
     version = getBenchmarkVersion()
     if len(sys.argv) <= 2:
-        print "Must specify the remote ip address of the influx database."
+        print("Must specify the remote ip address of the influx database.")
         printUseageAndQuit()
     remoteip = sys.argv[2]
     inputdir = "~/.realm/core/benchmarks/" + str(version) + "/" + str(machid)
@@ -332,14 +332,14 @@ def transform_remote():
     else:
         files = getFilesByName(inputdir)
     if len(sys.argv) > 5:
-        print "Unexpected extra arguments."
+        print("Unexpected extra arguments.")
         printUseageAndQuit()
     transform(inputdir, remoteip, files, handle_remote)
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print "Missing arguments."
+        print("Missing arguments.")
         printUseageAndQuit()
     locality = sys.argv[1]
     if locality == "--local":
@@ -349,8 +349,8 @@ if __name__ == "__main__":
     elif locality == "--remote":
         transform_remote()
     else:
-        print ("Expecting either '--local', '--local-html', "
-               "or '--remote' as the second argument.")
+        print("Expecting either '--local', '--local-html', "
+              "or '--remote' as the second argument.")
         printUseageAndQuit()
 
 
@@ -1,32 +1,62 @@
-from collections import OrderedDict
-import math
-import matplotlib as mpl
-# configure to use a backend that doesn't require a display since this
-# will be run from docker. It must be configured before importing pyplot
-mpl.use('Agg')
-import matplotlib.pyplot as plt
+from functools import lru_cache
+import gc
+import hashlib
+import multiprocessing
+# figures are drawn straight onto Agg canvases without going through
+# pyplot, so no display is needed when this is run from docker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.transforms as mtransforms
-from matplotlib.mlab import csv2rec
 from matplotlib.cbook import get_sample_data
+from matplotlib.figure import Figure
 from matplotlib.ticker import Formatter, MultipleLocator
+from natsort import index_natsorted
 import numpy as np
-from os.path import basename, splitext
+import pandas as pd
+from os.path import basename, exists, join, splitext
+import re
+
+
+# a graph only needs to be redrawn if its data or the code drawing it changed
+with open(__file__, 'rb') as generatorSource:
+    GENERATOR_DIGEST = hashlib.sha256(generatorSource.read()).digest()
+
+# favour fast png encoding over small files, the graphs are only
+# viewed through the html report
+PNG_OPTIONS = {'compress_level': 1}
+
+# graphs drawn by the same process reuse one figure per kind of graph, the
+# figures go away with the worker processes once all graphs are drawn
+graphFigures = {}
+graphsDrawn = 0
+# collect the artists of cleared graphs every so often
+GC_INTERVAL = 50
+# every graph has one tick per build. The locator and the tag formatters are
+# shared between graphs, which is fine since a process draws one at a time
+# and setting them on an axis rebinds them to it
+BUILD_LOCATOR = MultipleLocator(1)
+# tags as printed by git describe, e.g. v5.23.1 or v5.23.1-12-g4f2a6c1
+VERSION_TAG = re.compile(r'v?\d+(\.\d+)+')
 
 
 class TagFormatter(Formatter):
     def __init__(self, tags):
-        self.tags = tags
+        # labels are requested for every tick of every draw, convert once
+        self.labels = [str(tag) for tag in tags]
+        self.count = len(self.labels)
 
     def __call__(self, x, pos=0):
         'Return the label for time x at position pos'
         ind = int(round(x))
-        if ind >= len(self.tags) or ind < 0:
-            return ''
-        return str(self.tags[ind])
+        return self.labels[ind] if 0 <= ind < self.count else ''
 
 
-def writeReport(outputDirectory, summary, stats):
-    html = """
+@lru_cache(maxsize=64)
+def tagFormatter(tags):
+    # most graphs cover the same builds, only format their tags once
+    return TagFormatter(tags)
+
+
+REPORT_HEADER = """
         <html>
         <head>
             <style type=\"text/css\">
@@ -51,80 +81,144 @@ def writeReport(outputDirectory, summary, stats):
              </p>
             <br> """
 
-    # standard deviation summary graph
-    summaryGraphName = makeSummaryGraph(outputDirectory, summary)
-    html += ("<h1>Summary</h1>"
-             "<p>This summary graph shows the performance of each benchmark "
-             "as compared to the mean of all other runs on previous versions."
-             "The red line indicates the threshold of 2 standard deviations "
-             "from the mean. A benchmark is marked for further inspection if "
-             "the PR under test takes longer than this threshold. The same "
-             "line is shown on each of the individual graphs in the rest of "
-             "this report.</p>")
-    html += "<img align=\"middle\" id=\"summary\" src=\""
-    html += summaryGraphName + "\"/>"
-
-    # generate color coded link summary
-    html += "<ol>"
-    for title, values in summary.iteritems():
-        html += "<li><a class=\"" + values['status'] + "\" "
-        html += "href=#" + title + ">" + title + "</a></li>"
-    for title, values in stats.iteritems():
-        html += "<li><a class=\"stat\" href=#"
-        html += title.replace(' ', '_') + ">" + title + "</a></li>"
-    html += "</ol><br>"
-
-    # generate each graph section
-    for title, values in summary.iteritems():
-        html += "<h1 class=\"" + values['status']
-        html += "\" id=\"" + title + "\">" + title + "</h1>"
-        html += "<p>Threshold:  "
-        html += str(values['threshold']) + " (2 standard deviations)</p>"
-        html += "<p>Last Value: " + str(values['last_value'])
-        html += " (" + str(values['last_std']) + " standard deviations)</p>"
-        html += "<img align=\"middle\" src=\"" + values['src'] + "\"/>"
-
-    for title, values in stats.iteritems():
-        html += "<h1 class=\"stat\" id=\""
-        html += title.replace(' ', '_') + "\">" + title + "</h1>"
-        html += "<img align=\"middle\" src=\"" + values['src'] + "\"/>"
-
-    html += """
+REPORT_FOOTER = """
             </div>
         </body>
         </html>"""
 
-    with open(outputDirectory + str('report.html'), 'w+') as reportFile:
-        reportFile.write(html)
+
+def writeReport(outputDirectory, summary, stats):
+    # the report is written out as it is generated rather than being
+    # assembled in memory first
+    with open(join(outputDirectory, 'report.html'), 'w+') as reportFile:
+        write = reportFile.write
+        write(REPORT_HEADER)
+
+        # standard deviation summary graph
+        summaryGraphName = makeSummaryGraph(outputDirectory, summary)
+        write("<h1>Summary</h1>"
+              "<p>This summary graph shows the performance of each benchmark "
+              "as compared to the mean of all other runs on previous versions."
+              "The red line indicates the threshold of 2 standard deviations "
+              "from the mean. A benchmark is marked for further inspection if "
+              "the PR under test takes longer than this threshold. The same "
+              "line is shown on each of the individual graphs in the rest of "
+              "this report.</p>")
+        write("<img align=\"middle\" id=\"summary\" src=\"%s\"/>"
+              % summaryGraphName)
+
+        # generate color coded link summary
+        statAnchors = {title: title.replace(' ', '_') for title in stats}
+        links = ["<li><a class=\"%s\" href=#%s>%s</a></li>"
+                 % (values['status'], title, title)
+                 for title, values in summary.items()]
+        links.extend("<li><a class=\"stat\" href=#%s>%s</a></li>"
+                     % (statAnchors[title], title) for title in stats)
+        write("<ol>")
+        reportFile.writelines(links)
+        write("</ol><br>")
+
+        # generate each graph section
+        for title, values in summary.items():
+            write("<h1 class=\"%s\" id=\"%s\">%s</h1>"
+                  % (values['status'], title, title))
+            if values['threshold'] is None:
+                write("<p>Threshold:  none, there is no history to compare "
+                      "with</p>")
+            else:
+                write("<p>Threshold:  %s (2 standard deviations)</p>"
+                      % values['threshold'])
+            write("<p>Last Value: %s (%s standard deviations)</p>"
+                  % (values['last_value'], values['last_std']))
+            write("<img align=\"middle\" src=\"%s\"/>" % values['src'])
+
+        for title, values in stats.items():
+            write("<h1 class=\"stat\" id=\"%s\">%s</h1>"
+                  % (statAnchors[title], title))
+            write("<img align=\"middle\" src=\"%s\"/>" % values['src'])
+
+        write(REPORT_FOOTER)
+
+
+def graphKey(fname):
+    key = hashlib.sha256(GENERATOR_DIGEST)
+    with open(fname, 'rb') as dataFile:
+        key.update(dataFile.read())
+    return key.hexdigest()
+
+
+def isGraphCurrent(imgPath, key):
+    # the key of the data a graph was drawn from is stored next to it
+    if not exists(imgPath):
+        return False
+    try:
+        with open(imgPath + '.sha256') as keyFile:
+            return keyFile.read().strip() == key
+    except IOError:
+        return False
+
+
+def storeGraphKey(imgPath, key):
+    with open(imgPath + '.sha256', 'w+') as keyFile:
+        keyFile.write(key)
 
 
 def autoscale_based_on(ax, lines):
+    # scale to the combined extents of all lines in a single update, with
+    # ignore=True to escape being limited to the unit bounding box. Missing
+    # measurements are NaN and are skipped like any non finite point
+    xs = np.concatenate([line.get_xdata() for line in lines])
+    ys = np.concatenate([line.get_ydata() for line in lines])
+    xy = np.column_stack([xs, ys])
     ax.dataLim = mtransforms.Bbox.unit()
-    # call once with ignore=True to escape being
-    # limited to the unit bounding box
-    fxy = np.vstack(lines[0].get_data()).T
-    ax.dataLim.update_from_data_xy(fxy, ignore=True)
-    for line in lines:
-        xy = np.vstack(line.get_data()).T
-        ax.dataLim.update_from_data_xy(xy, ignore=False)
+    ax.dataLim.update_from_data_xy(xy, ignore=True)
     ax.autoscale_view()
 
 
+def readBenchData(fname):
+    bench_data = pd.read_csv(fname).to_records(index=False)
+    # the rows are in commit timestamp order, with the build under test
+    # last where getThreshold expects it. For display, lay the builds
+    # before it out along the x axis by version; the threshold statistics
+    # don't depend on the order. Only do so when all of their tags are
+    # versions, git describe falls back to a bare sha when there are no
+    # tags, which has no useful order.
+    # Natural sorting doesn't know about pre-releases, so a tag like
+    # v6.0.0-alpha.17 would be placed after v6.0.0 rather than before it
+    history = bench_data['tag'][:-1]
+    if all(VERSION_TAG.match(str(tag)) for tag in history):
+        order = index_natsorted(history) + [len(bench_data) - 1]
+        bench_data = bench_data[order]
+    return bench_data
+
+
 def getThreshold(points):
-    # assumes that data has 2 or more points
-    # remove the last value from computation since we are testing it
-    data = points[:-1]
-    mean = float(sum(data)) / max(len(data), 1)
-    variance = 0
-    deviations = [math.pow(x - mean, 2) for x in data]
-    variance = sum(deviations) / max(len(deviations), 1)
-    std = math.sqrt(variance)
+    last_value = float(points[-1])
+    # remove the last value from computation since we are testing it,
+    # missing measurements are loaded as NaN and left out as well
+    data = np.asarray(points[:-1], dtype=np.float64)
+    data = data[np.isfinite(data)]
+    if not len(data):
+        # a new benchmark has no history to be compared with, so there is
+        # no threshold. Flag it for inspection rather than letting it pass
+        return [None, last_value, np.inf]
+    mean = data.mean()
+    # population standard deviation
+    std = data.std()
     # we define the warninng threshold as 2 standard deviations from the mean
     threshold = mean + (2 * std)
-    last_value = points[-1]
     # last_std is the distance of the last value (the one under test)
     # from the mean, in units of standard deviations
-    last_std = (last_value - mean) / std
+    if np.isnan(last_value):
+        # the measurement under test is missing, flag it for inspection
+        last_std = np.inf
+    elif std:
+        last_std = (last_value - mean) / std
+    elif last_value != mean:
+        # any change from a constant history is infinitely far off
+        last_std = np.copysign(np.inf, last_value - mean)
+    else:
+        last_std = 0.0
     return [threshold, last_value, last_std]
 
 
@@ -132,15 +226,21 @@ def makeSummaryGraph(outputDirectory, summary):
     summaryGraphName = "summary.png"
 
     ratios = {title: summary[title]['last_std'] for title in summary}
-    ratios = OrderedDict(sorted(ratios.items(), reverse=True))
+    ratios = dict(sorted(ratios.items(), reverse=True))
 
     # the y locations for the groups
     indices = range(len(ratios))
     width = 1
     widths = [width/2.0] * len(ratios)
 
-    fig, ax = plt.subplots()
-    rects1 = ax.barh(indices, ratios.values(), width, color='b')
+    # sized for viewing in the html report
+    fig = Figure(figsize=(8, 12), dpi=72, constrained_layout=True)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    # benchmarks without a spread in their history can be infinitely far
+    # off, let their bars run off the edge of the graph
+    bars = np.clip(list(ratios.values()), -5, 5)
+    rects1 = ax.barh(indices, bars, width, color='b')
 
     # add some text for labels, title and axes ticks
     ax.set_xlabel('Standard Deviation')
@@ -148,120 +248,163 @@ def makeSummaryGraph(outputDirectory, summary):
     ax.set_yticks(indices)
     ax.set_yticklabels('')
     ax.set_yticks([x + (width/2.0) for x in indices], minor=True)
-    ax.set_yticklabels(ratios.keys(), minor=True)
+    ax.set_yticklabels(list(ratios.keys()), minor=True)
     ax.set_ylim([0, len(ratios)])
     ax.set_xlim([-4, 4])
     # 2 std threshold line
-    plt.axvline(x=2, color='r')
+    ax.axvline(x=2, color='r')
 
-    fig.set_size_inches(10, 16)
-    plt.tight_layout()
-    plt.savefig(outputDirectory + summaryGraphName)
-    plt.close(fig)
+    canvas.print_png(join(outputDirectory, summaryGraphName),
+                     pil_kwargs=PNG_OPTIONS)
 
     return summaryGraphName
 
 
-def generateStats(outputDirectory, statsfiles):
-    summary = {}
+def clearedGraph(kind):
+    global graphsDrawn
+    graphsDrawn += 1
+    if graphsDrawn % GC_INTERVAL == 0:
+        gc.collect()
+    if kind not in graphFigures:
+        fig = Figure(figsize=(12, 6), constrained_layout=True)
+        graphFigures[kind] = (FigureCanvasAgg(fig), fig.add_subplot(111))
+    canvas, ax = graphFigures[kind]
+    ax.clear()
+    return canvas, ax
+
+
+def renderStatsGraph(job):
+    index, count, fname, outputDirectory = job
     colors = ['yellow', 'indigo', 'orange', 'lightblue', 'green', 'violet',
               'orangered', 'gray', 'lightblue', 'limegreen', 'navy']
-    for index, fname in enumerate(statsfiles):
-        bench_data = csv2rec(fname)
-        # FIXME This sorts alphabetically, doesn't work whith multidigit numbers
-        # ideally we would want something that understands semantic versioning
-        # bench_data = np.sort(bench_data, order='tag')
-        print ("generating stats graph: " + str(index + 1) +
-               "/" + str(len(statsfiles)) + " (" + fname + ")")
-        formatter = TagFormatter(bench_data['tag'])
-        fig, ax = plt.subplots()
-        ax.xaxis.set_major_formatter(formatter)
-        tick_spacing = 1
-        ax.xaxis.set_major_locator(MultipleLocator(tick_spacing))
-        plt.grid(True)
-        exclusions = ['sha', 'tag']
-        lines = []
-        for ndx, col in enumerate(bench_data.dtype.names):
-            if col not in exclusions:
-                line, = plt.plot(bench_data[col], lw=2.5,
-                                 color=colors[ndx % len(colors)])
-                line.set_label(col)
-                lines.append(line)
-        autoscale_based_on(ax, lines)
-        plt.legend(loc='upper left', fancybox=True, framealpha=0.7)
-        plt.xlabel('Build')
-        plt.ylabel('')
-        # rotate x axis labels for readability
-        fig.autofmt_xdate()
-        title = splitext(basename(fname))[0]
-        plt.title(title, fontsize=18, ha='center')
-        imgName = str(title) + '.png'
-        fig.set_size_inches(12, 6)
-        plt.tight_layout()
-        plt.savefig(outputDirectory + imgName)
-        # refresh axis and don't store these in memory
-        plt.close(fig)
-        summary[title] = {'title': title, 'src': imgName}
-    return summary
+    title = splitext(basename(fname))[0]
+    imgName = str(title) + '.png'
+    imgPath = join(outputDirectory, imgName)
+    entry = {'title': title, 'src': imgName}
+    key = graphKey(fname)
+    if isGraphCurrent(imgPath, key):
+        print("stats graph is up to date: " + str(index + 1) +
+              "/" + str(count) + " (" + fname + ")")
+        return title, entry
+
+    bench_data = readBenchData(fname)
+    print("generating stats graph: " + str(index + 1) +
+          "/" + str(count) + " (" + fname + ")")
+    formatter = tagFormatter(tuple(bench_data['tag']))
+    canvas, ax = clearedGraph('stats')
+    ax.xaxis.set_major_formatter(formatter)
+    ax.xaxis.set_major_locator(BUILD_LOCATOR)
+    ax.grid(True)
+    exclusions = ['sha', 'tag']
+    # colors follow the position of the column in the file
+    columns = [(ndx, col) for ndx, col in enumerate(bench_data.dtype.names)
+               if col not in exclusions]
+    ax.set_prop_cycle(color=[colors[ndx % len(colors)]
+                             for ndx, _ in columns])
+    names = [col for _, col in columns]
+    lines = ax.plot(np.column_stack([bench_data[col] for col in names]),
+                    lw=2.5)
+    for line, col in zip(lines, names):
+        line.set_label(col)
+    autoscale_based_on(ax, lines)
+    ax.legend(loc='upper left', fancybox=True, framealpha=0.7)
+    ax.set_xlabel('Build')
+    ax.set_ylabel('')
+    # rotate x axis labels for readability
+    for label in ax.get_xticklabels():
+        label.set_rotation(30)
+        label.set_ha('right')
+    ax.set_title(title, fontsize=18, ha='center')
+    canvas.print_png(imgPath, pil_kwargs=PNG_OPTIONS)
+    storeGraphKey(imgPath, key)
+    return title, entry
+
+
+def renderReportGraph(job):
+    index, count, fname, outputDirectory = job
+    colors = {'range': '#aec7e8', 'med': '#ff7f0e', 'avg': '#ffbb78',
+              'threshold': '#ff1111'}
+
+    bench_data = readBenchData(fname)
+
+    title = splitext(basename(fname))[0]
+    imgName = str(title) + '.png'
+    imgPath = join(outputDirectory, imgName)
+    threshold, last_value, last_std = getThreshold(bench_data['avg'])
+    # benchmarks that can't be compared with their history fail as well
+    failed = (threshold is None or np.isnan(last_value) or
+              last_value > threshold)
+    status = "fail" if failed else "pass"
+    entry = {'title': title, 'src': imgName,
+             'threshold': threshold, 'last_value': last_value,
+             'last_std': last_std, 'status': status}
+    key = graphKey(fname)
+    if isGraphCurrent(imgPath, key):
+        print("graph is up to date: " + str(index + 1) + "/" +
+              str(count) + " (" + fname + ")")
+        return title, entry
+
+    print("generating graph: " + str(index + 1) + "/" +
+          str(count) + " (" + fname + ")")
+    formatter = tagFormatter(tuple(bench_data['tag']))
+
+    canvas, ax = clearedGraph('report')
+    ax.xaxis.set_major_formatter(formatter)
+    ax.xaxis.set_major_locator(BUILD_LOCATOR)
+
+    ax.grid(True)
+    # min and max are only context for the median and average, draw them
+    # as a single band instead of two more lines
+    ax.fill_between(range(len(bench_data)), bench_data['min'],
+                    bench_data['max'], color=colors['range'], alpha=0.4,
+                    label='min-max')
+    med_line, = ax.plot(bench_data['med'], lw=2.5, color=colors['med'],
+                        label='med')
+    avg_line, = ax.plot(bench_data['avg'], lw=2.5, color=colors['avg'],
+                        label='avg')
+
+    # don't let outliers in the min-max band squash the interesting lines
+    autoscale_based_on(ax, [med_line, avg_line])
+    ax.legend(loc='upper left', fancybox=True, framealpha=0.7)
+    ax.set_xlabel('Build')
+    ax.set_ylabel('Seconds')
+    # rotate x axis labels for readability
+    for label in ax.get_xticklabels():
+        label.set_rotation(30)
+        label.set_ha('right')
+
+    if threshold is not None:
+        ax.axhline(y=threshold, color=colors['threshold'])
+
+    ax.set_title(title, fontsize=18, ha='center')
+    canvas.print_png(imgPath, pil_kwargs=PNG_OPTIONS)
+    storeGraphKey(imgPath, key)
+    return title, entry
+
+
+def renderGraphs(render, outputDirectory, files):
+    # each graph is drawn to its own figure and file, so they can be drawn
+    # in parallel. matplotlib is not thread safe, but every worker process has
+    # its own copy of its state
+    jobs = [(index, len(files), fname, outputDirectory)
+            for index, fname in enumerate(files)]
+    pool = multiprocessing.Pool()
+    try:
+        return dict(pool.map(render, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def generateStats(outputDirectory, statsfiles):
+    return renderGraphs(renderStatsGraph, outputDirectory, statsfiles)
 
 
 def generateReport(outputDirectory, csvFiles, statsfiles):
-    metrics = ['min', 'max', 'med', 'avg']
-    colors = {'min': '#1f77b4', 'max': '#aec7e8', 'med': '#ff7f0e',
-              'avg': '#ffbb78', 'threshold': '#ff1111'}
-
-    summary = {}
-
-    for index, fname in enumerate(csvFiles):
-        bench_data = csv2rec(fname)
-        # do not assume that the csv files are ordered correctly (they are not)
-        # well....actually, they are! (they are in commit timestamp order AFAIK)
-        # FIXME This sorts alphabetically, doesn't work whith multidigit numbers
-        # ideally we would want something that understands semantic versioning
-        # bench_data = np.sort(bench_data, order='tag')
-
-        print ("generating graph: " + str(index + 1) + "/" +
-               str(len(csvFiles)) + " (" + fname + ")")
-        formatter = TagFormatter(bench_data['tag'])
-
-        fig, ax = plt.subplots()
-        ax.xaxis.set_major_formatter(formatter)
-        tick_spacing = 1
-        ax.xaxis.set_major_locator(MultipleLocator(tick_spacing))
-
-        lines_to_scale_to = []
-        plt.grid(True)
-        for rank, column in enumerate(metrics):
-            line, = plt.plot(bench_data[column], lw=2.5, color=colors[column])
-            line.set_label(column)
-            if column != "max":
-                lines_to_scale_to.append(line)
-
-        autoscale_based_on(ax, lines_to_scale_to)
-        plt.legend(loc='upper left', fancybox=True, framealpha=0.7)
-        plt.xlabel('Build')
-        plt.ylabel('Seconds')
-        # rotate x axis labels for readability
-        fig.autofmt_xdate()
-
-        threshold, last_value, last_std = getThreshold(bench_data['avg'])
-        plt.axhline(y=threshold, color=colors['threshold'])
-
-        title = splitext(basename(fname))[0]
-        plt.title(title, fontsize=18, ha='center')
-        imgName = str(title) + '.png'
-        fig.set_size_inches(12, 6)
-        plt.tight_layout()
-        plt.savefig(outputDirectory + imgName)
-        # refresh axis and don't store these in memory
-        plt.close(fig)
-        status = "fail" if last_value > threshold else "pass"
-        summary[title] = {'title': title, 'src': imgName,
-                          'threshold': threshold, 'last_value': last_value,
-                          'last_std': last_std, 'status': status}
-
-    stats = OrderedDict(sorted(generateStats(outputDirectory,
-                                             statsfiles).items()))
-    summary = OrderedDict(sorted(summary.items()))
+    summary = renderGraphs(renderReportGraph, outputDirectory, csvFiles)
+
+    # dicts keep their insertion order, so these stay sorted by title
+    stats = dict(sorted(generateStats(outputDirectory, statsfiles).items()))
+    summary = dict(sorted(summary.items()))
     writeReport(outputDirectory, summary, stats)
 